@@ -16,25 +16,59 @@ Usage:
 """
 
 # Import needed libraries
-import xarray as xr
+import functools
+import io
+import os
+import tempfile
+import zarr
 import numpy as np
-import s3fs
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+import fsspec
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Conversion factor from cubic feet per second (cfs) to cubic meters per second (cms)
 CFS_TO_CMS = 0.0283168
 
+# NWM retrospective Zarr stores on AWS
+NWM_V21_URL = "s3://noaa-nwm-retrospective-2-1-zarr-pds/chrtout.zarr"
+NWM_V3_URL = "s3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr"
+
+# Local directory for data cached between runs (set STREAMFLOW_PLOTTER_NO_CACHE to disable it)
+CACHE_DIR = os.environ.get(
+    'STREAMFLOW_PLOTTER_CACHE_DIR', os.path.expanduser('~/.cache/streamflow_plotter')
+)
+USE_DISK_CACHE = not os.environ.get('STREAMFLOW_PLOTTER_NO_CACHE')
+
+# Options for the anonymous S3 filesystem holding the NWM stores. The pool is capped and
+# retries back off adaptively so bursts of chunk requests are not throttled by S3 or left
+# hanging on a stalled connection.
+NWM_S3_OPTIONS = dict(
+    anon=True,
+    config_kwargs=dict(
+        max_pool_connections=32,
+        retries={'max_attempts': 5, 'mode': 'adaptive'},
+        connect_timeout=5,
+        read_timeout=30,
+        tcp_keepalive=True,
+    ),
+)
+
 # USGS Parameter Code
 parameter_code = '00060'  # Discharge in cfs; for some stations, tidal filter ID is 72137;00060 Discharge
 
+# Shared HTTP session so repeated USGS requests reuse pooled, gzip-compressed connections
+usgs_session = requests.Session()
+usgs_session.headers['Accept-Encoding'] = 'gzip'
+usgs_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 # Function to retrieve USGS data from Water Services API and convert from cfs to cms
 def ReadUSGSData(station_id, start_date, end_date):
     url = f"https://waterservices.usgs.gov/nwis/iv/?format=json&sites={station_id}&startDT={start_date}&endDT={end_date}&parameterCd={parameter_code}"
-    response = requests.get(url)
+    response = usgs_session.get(url, timeout=30)
+    response.raise_for_status()
     data = response.json()
 
     # Check if timeSeries data is available
@@ -43,87 +77,251 @@ def ReadUSGSData(station_id, start_date, end_date):
             f"No USGS data available for station {station_id} from {start_date} to {end_date}"
         )
 
-    # Extract flow values and timestamps
-    flow_vals = []
-    time_vals = []
-    for value in data['value']['timeSeries'][0]['values'][0]['value']:
-        flow_vals.append(float(value['value']) * CFS_TO_CMS)  # Convert cfs to cms
-        time_vals.append(pd.to_datetime(value['dateTime']))
+    # Extract flow values and timestamps as columns, converting each in a single call
+    values = pd.json_normalize(data['value']['timeSeries'][0]['values'][0]['value'])
+    if values.empty:
+        raise ValueError(
+            f"No USGS data available for station {station_id} from {start_date} to {end_date}"
+        )
+    # Nanosecond resolution matches the NWM readers; newer pandas would otherwise pick microseconds
+    time_vals = pd.DatetimeIndex(pd.to_datetime(values['dateTime'], utc=True)).as_unit('ns')
+    # Convert cfs to cms in double precision, then store as float32 (ample for 3 significant figures)
+    flow_vals = (values['value'].astype(np.float64).to_numpy() * CFS_TO_CMS).astype(np.float32)
 
     return time_vals, flow_vals
 
-# Function to retrieve the time series for a specified reach ID
-def GetTimeSeriesAtReach(store, reach_id, start_time_index, end_time_index):
-    streamflow_array = store['streamflow']
-    feature_id_array = store['feature_id']
-    flows = streamflow_array.where(feature_id_array == reach_id, drop=True)
-    return flows[start_time_index:end_time_index].values
+# Function to write a file under a unique temporary name and rename it into place, so
+# concurrent readers and writers never see a partly written file
+def WriteFileAtomically(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
 
-# Function to get the time array directly without conversion
-def GetTimeArray(store, start_time_index, end_time_index):
-    time_array = store['time']
-    return time_array[start_time_index:end_time_index].values
+# Read-only filesystem that keeps every object fetched from the target filesystem in its
+# own local file. Unlike fsspec's filecache it has no shared index to update, so zarr's
+# chunk threads and both NWM readers can use one instance at the same time.
+class DiskCachedFileSystem(fsspec.AbstractFileSystem):
+    cachable = False
 
-# Function to read NWM v2.1 data from AWS without downloading
-def ReadNWMv21Data(reach_id, start_time, end_time):
-    url = "s3://noaa-nwm-retrospective-2-1-zarr-pds/chrtout.zarr"
-    fs = s3fs.S3FileSystem(anon=True)
-    store = xr.open_zarr(s3fs.S3Map(url, s3=fs), consolidated=False)
+    def __init__(self, target_fs, cache_storage, **kwargs):
+        super().__init__(**kwargs)
+        self.target_fs = target_fs
+        self.cache_storage = cache_storage
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        local_path = os.path.join(self.cache_storage, self._strip_protocol(path).lstrip('/'))
+        try:
+            with open(local_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = self.target_fs.cat_file(path)
+            WriteFileAtomically(local_path, data)
+        return data[start:end]
+
+    def info(self, path, **kwargs):
+        return self.target_fs.info(path, **kwargs)
+
+    def ls(self, path, detail=True, **kwargs):
+        return self.target_fs.ls(path, detail=detail, **kwargs)
+
+# Function to get the S3 filesystem shared by both NWM stores, created on first use so
+# importing this module neither connects nor creates the cache directory
+@functools.lru_cache(maxsize=1)
+def GetNWMFileSystem():
+    s3_fs = fsspec.filesystem('s3', **NWM_S3_OPTIONS)
+    if not USE_DISK_CACHE:
+        return s3_fs
+
+    # Every object fetched is kept on local disk so later runs skip the download
+    return DiskCachedFileSystem(s3_fs, os.path.join(CACHE_DIR, 'zarr'))
+
+# Function to open an NWM Zarr store on AWS (opened once per URL and reused).
+# The raw Zarr group is used directly: reading one reach needs none of xarray's dataset machinery.
+# The NWM stores are Zarr v2, so naming the format skips a remote probe for v3 metadata.
+@functools.lru_cache(maxsize=8)
+def OpenNWMStore(url):
+    mapper = GetNWMFileSystem().get_mapper(url.removeprefix('s3://'))
+    return zarr.open_consolidated(mapper, mode='r', zarr_format=2)
+
+# Function to load the feature ID array of a store, keeping a local copy for later runs.
+# The raw chunks also sit in the Zarr disk cache, but this copy is already decoded, so
+# later runs read it with a single np.load instead of decompressing every chunk again.
+@functools.lru_cache(maxsize=8)
+def LoadFeatureIds(url):
+    if not USE_DISK_CACHE:
+        return OpenNWMStore(url)['feature_id'][:]
+
+    cache_path = os.path.join(
+        CACHE_DIR, url.replace('s3://', '').replace('/', '_') + '.feature_id.npy'
+    )
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    feature_ids = OpenNWMStore(url)['feature_id'][:]
+
+    buffer = io.BytesIO()
+    np.save(buffer, feature_ids)
+    WriteFileAtomically(cache_path, buffer.getvalue())
 
-    zero_start_time = np.datetime64('1979-02-01T00:00:00')
-    start_time_index = int((np.datetime64(start_time) - zero_start_time) / np.timedelta64(1, 'h'))
-    end_time_index = int((np.datetime64(end_time) - zero_start_time) / np.timedelta64(1, 'h'))
+    return feature_ids
 
-    time_series = GetTimeSeriesAtReach(store, reach_id, start_time_index, end_time_index)
-    time_vals = GetTimeArray(store, start_time_index, end_time_index)
+# Function to find the position of a reach ID in the store's feature ID array
+@functools.lru_cache(maxsize=64)
+def GetReachIndex(url, reach_id):
+    matches = np.flatnonzero(LoadFeatureIds(url) == reach_id)
+    if matches.size == 0:
+        raise ValueError(f"Reach ID {reach_id} not found in NWM store {url}")
+    return int(matches[0])
 
-    return time_vals, time_series
+# Function to load and decode the time coordinate of a store once per URL.
+# NWM times use the standard calendar with "<unit> since <epoch>" units, which pandas decodes.
+@functools.lru_cache(maxsize=8)
+def LoadTimes(url):
+    time_array = OpenNWMStore(url)['time']
+    calendar = time_array.attrs.get('calendar', 'standard')
+    if calendar not in ('standard', 'gregorian', 'proleptic_gregorian'):
+        raise ValueError(f"Unsupported calendar {calendar!r} in NWM store {url}")
+
+    unit, _, epoch = time_array.attrs['units'].partition(' since ')
+    epoch = pd.Timestamp(epoch)
+    if epoch.tzinfo is not None:
+        epoch = epoch.tz_convert(None)
+    times = epoch + pd.to_timedelta(time_array[:], unit=unit)
+    return times.to_numpy(dtype='datetime64[ns]')
+
+# Function to list the raw values marked as missing, matching xarray's CF mask step:
+# Zarr v2 keeps _FillValue as the array's fill_value, Zarr v3 as an attribute
+def GetMissingValues(array):
+    zarr_format = getattr(getattr(array, 'metadata', None), 'zarr_format', 2)
+    fill_value = array.fill_value if zarr_format == 2 else array.attrs.get('_FillValue')
+    missing_values = list(np.atleast_1d(array.attrs.get('missing_value', [])))
+    return [value for value in [fill_value, *missing_values] if value is not None]
+
+# Function to retrieve the time array and time series at a reach between two times (inclusive)
+def GetTimeSeriesAtReach(url, reach_index, start_time, end_time):
+    # Resolve the requested period against the store's own time coordinate
+    times = LoadTimes(url)
+    start_index = np.searchsorted(times, np.datetime64(start_time), side='left')
+    end_index = np.searchsorted(times, np.datetime64(end_time), side='right')
+
+    # Read only the chunks holding this reach and period, then apply the CF packing attributes.
+    # zarr fetches those chunks from several threads at once, which DiskCachedFileSystem allows.
+    streamflow = OpenNWMStore(url)['streamflow']
+    raw_flows = streamflow[start_index:end_index, reach_index]
+    flows = (
+        raw_flows * streamflow.attrs.get('scale_factor', 1.0)
+        + streamflow.attrs.get('add_offset', 0.0)
+    )
+    flows = np.where(np.isin(raw_flows, GetMissingValues(streamflow)), np.nan, flows)
+
+    return times[start_index:end_index], flows
+
+# Function to read NWM v2.1 data from AWS without downloading
+def ReadNWMv21Data(reach_id, start_time, end_time):
+    reach_index = GetReachIndex(NWM_V21_URL, reach_id)
+    return GetTimeSeriesAtReach(NWM_V21_URL, reach_index, start_time, end_time)
 
 # Function to read NWM v3 data from AWS without downloading
 def ReadNWMv3Data(reach_id, start_time, end_time):
-    url = "s3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr"
-    fs = s3fs.S3FileSystem(anon=True)
-    store = xr.open_zarr(s3fs.S3Map(url, s3=fs), consolidated=False)
+    reach_index = GetReachIndex(NWM_V3_URL, reach_id)
+    return GetTimeSeriesAtReach(NWM_V3_URL, reach_index, start_time, end_time)
+
+# Function to reduce a series to its first, last, min and max point per pixel column (M4)
+def DownsampleForPlotting(time_vals, flow_vals, n_columns):
+    flow_vals = np.asarray(flow_vals)
+    if len(flow_vals) <= 4 * n_columns:
+        return time_vals, flow_vals
 
-    zero_start_time = np.datetime64('1979-02-01T00:00:00')
-    start_time_index = int((np.datetime64(start_time) - zero_start_time) / np.timedelta64(1, 'h'))
-    end_time_index = int((np.datetime64(end_time) - zero_start_time) / np.timedelta64(1, 'h'))
+    # Assign each sample to the pixel column its timestamp falls in
+    time_ns = pd.DatetimeIndex(time_vals).asi8
+    span = max(time_ns[-1] - time_ns[0], 1)
+    columns = np.minimum(
+        (time_ns - time_ns[0]) / span * n_columns, n_columns - 1
+    ).astype(np.int64)
 
-    time_series = GetTimeSeriesAtReach(store, reach_id, start_time_index, end_time_index)
-    time_vals = GetTimeArray(store, start_time_index, end_time_index)
+    # Sort by column and then by flow, so each column's min and max sit at its ends.
+    # NaN is sorted past the opposite end each time so it never hides the real min or max.
+    is_nan = np.isnan(flow_vals)
+    order_min = np.lexsort((np.where(is_nan, np.inf, flow_vals), columns))
+    order_max = np.lexsort((np.where(is_nan, -np.inf, flow_vals), columns))
+    starts = np.flatnonzero(np.diff(columns, prepend=-1))
+    ends = np.append(starts[1:], len(columns)) - 1
 
-    return time_vals, time_series
+    # Keep one NaN per column that has any, so gaps in the data still show as gaps
+    nan_indices = np.flatnonzero(is_nan)
+    first_nans = nan_indices[np.unique(columns[nan_indices], return_index=True)[1]]
 
-# Function to truncate data for plotting (ensures v2.1 and v3 have the same length)
-def TruncateForPlotting(time_vals_v21, flow_vals_v21, time_vals_v3, flow_vals_v3):
-    min_length = min(len(flow_vals_v21), len(flow_vals_v3))
-    return time_vals_v21[:min_length], flow_vals_v21[:min_length], time_vals_v3[:min_length], flow_vals_v3[:min_length]
+    keep = np.unique(np.concatenate(
+        [starts, ends, order_min[starts], order_max[ends], first_nans]
+    ))
+
+    return time_vals[keep], flow_vals[keep]
 
 # Function to create the streamflow graph with the x-axis formatted for daily tick intervals
 def CreateStreamflowGraph(time_vals_v21, flow_vals_v21, time_vals_v3, flow_vals_v3, time_vals_usgs, flow_vals_usgs):
-    plt.figure(figsize=(10, 6))
-
-    # Plot NWM v2.1 data
-    plt.plot(time_vals_v21, flow_vals_v21, label='NWM v2.1 Streamflow', color='blue')
-    # Plot NWM v3 data
-    plt.plot(time_vals_v3, flow_vals_v3, label='NWM v3 Streamflow', color='red')
-    # Plot USGS data
-    plt.plot(time_vals_usgs, flow_vals_usgs, label='USGS Streamflow',
-             color='black', linestyle='--')
-
-    # Format the x-axis to show daily timestamps
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-    plt.gca().xaxis.set_major_locator(mdates.DayLocator())  # Tick every day
-
-    plt.xlabel('Date (Daily)')
-    plt.ylabel('Streamflow (cms)')
-    plt.title(f'Daily Streamflow at Fish River Near Silver Hill, AL (NWMID#{reach_id})')
-    plt.legend(loc='upper right')
-
-    plt.xticks(rotation=45)
-    plt.grid(True, linestyle='--')
-    plt.tight_layout()
-    plt.show()
+    # Imported here so reading data without plotting skips the Matplotlib import cost
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    # Drop sub-pixel line segments and draw long paths in chunks, for this figure only.
+    # The figure is drawn before the context exits so the lines' paths keep the simplification
+    # even when plt.show() does not block; later redraws, such as a savefig, run without
+    # the chunked Agg drawing.
+    with plt.rc_context({
+        'path.simplify': True,
+        'path.simplify_threshold': 1.0,
+        'agg.path.chunksize': 10000,
+    }):
+        fig = plt.figure(figsize=(10, 6))
+
+        # Keep at most four points per pixel column; the drawn envelope is unchanged
+        n_columns = int(fig.get_figwidth() * fig.dpi)
+        time_vals_v21, flow_vals_v21 = DownsampleForPlotting(time_vals_v21, flow_vals_v21, n_columns)
+        time_vals_v3, flow_vals_v3 = DownsampleForPlotting(time_vals_v3, flow_vals_v3, n_columns)
+        time_vals_usgs, flow_vals_usgs = DownsampleForPlotting(time_vals_usgs, flow_vals_usgs, n_columns)
+
+        # Plot NWM v2.1 data
+        plt.plot(time_vals_v21, flow_vals_v21, label='NWM v2.1 Streamflow', color='blue',
+                 rasterized=True)
+        # Plot NWM v3 data
+        plt.plot(time_vals_v3, flow_vals_v3, label='NWM v3 Streamflow', color='red',
+                 rasterized=True)
+        # Plot USGS data
+        plt.plot(time_vals_usgs, flow_vals_usgs, label='USGS Streamflow',
+                 color='black', linestyle='--', rasterized=True)
+
+        # Format the x-axis to show daily timestamps, with the day ticks computed once up front.
+        # Ticks stay within the combined data range so they never widen the view.
+        ax = plt.gca()
+        series_times = [
+            pd.to_datetime(time_vals, utc=True)
+            for time_vals in (time_vals_v21, time_vals_v3, time_vals_usgs) if len(time_vals)
+        ]
+        if series_times:
+            days = pd.date_range(
+                min(times.min() for times in series_times).ceil('D'),
+                max(times.max() for times in series_times).floor('D'),
+                freq='D',
+            )
+            ax.set_xticks(days)  # Tick every day
+        ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(ax.xaxis.get_major_locator()))
+
+        plt.xlabel('Date (Daily)')
+        plt.ylabel('Streamflow (cms)')
+        plt.title(f'Daily Streamflow at Fish River Near Silver Hill, AL (NWMID#{reach_id})')
+        plt.legend(loc='upper right')
+
+        plt.xticks(rotation=45)
+        plt.grid(True, linestyle='--')
+        plt.tight_layout()
+        fig.canvas.draw()
+        plt.show()
 
 # Main execution
 if __name__ == "__main__":
@@ -132,23 +330,25 @@ if __name__ == "__main__":
     start_time = '2020-08-24T00:00:00'
     end_time = '2020-09-03T23:59:59'
 
-    # Retrieve NWM v2.1 and v3 data
-    time_vals_v21, flow_vals_v21 = ReadNWMv21Data(reach_id, start_time, end_time)
-    time_vals_v3, flow_vals_v3 = ReadNWMv3Data(reach_id, start_time, end_time)
+    # Retrieve NWM v2.1 and v3 data and USGS data for the same period concurrently.
+    # Both NWM readers share one disk-cached filesystem, which is safe to use from several threads.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        future_v21 = executor.submit(ReadNWMv21Data, reach_id, start_time, end_time)
+        future_v3 = executor.submit(ReadNWMv3Data, reach_id, start_time, end_time)
+        future_usgs = executor.submit(
+            ReadUSGSData, usgs_station_id, '2020-08-24', '2020-09-03'
+        )
 
-    # Retrieve USGS data for the same period
-    time_vals_usgs, flow_vals_usgs = ReadUSGSData(
-        usgs_station_id, '2020-08-24', '2020-09-03'
-    )
+        time_vals_v21, flow_vals_v21 = future_v21.result()
+        time_vals_v3, flow_vals_v3 = future_v3.result()
+        time_vals_usgs, flow_vals_usgs = future_usgs.result()
 
-    # Truncate NWM datasets for consistent plotting
-    time_vals_v21_plot, flow_vals_v21_plot, time_vals_v3_plot, flow_vals_v3_plot = TruncateForPlotting(
-        time_vals_v21, flow_vals_v21, time_vals_v3, flow_vals_v3
-    )
+    # Truncate NWM datasets to the same length for consistent plotting (slices are views)
+    min_length = min(flow_vals_v21.shape[0], flow_vals_v3.shape[0])
 
     # Create the streamflow graph
     CreateStreamflowGraph(
-        time_vals_v21_plot, flow_vals_v21_plot,
-        time_vals_v3_plot, flow_vals_v3_plot,
+        time_vals_v21[:min_length], flow_vals_v21[:min_length],
+        time_vals_v3[:min_length], flow_vals_v3[:min_length],
         time_vals_usgs, flow_vals_usgs
     )
@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import fsspec
+import numpy as np
+import pandas as pd
+import pytest
+import zarr
+
+import streamflow_plotter
+
+FILL_VALUE = -999900
+START_TIME = '2020-06-10T00:00:00'
+END_TIME = '2020-08-10T23:59:59'
+
+
+# Function to write a small consolidated Zarr v2 store laid out like NWM's chrtout.zarr
+def MakeChrtoutStore(path, seed):
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2020-06-01', periods=2000, freq='h')
+    minutes = (times - pd.Timestamp('1970-01-01')) // pd.Timedelta(minutes=1)
+    feature_ids = np.arange(5000, 5400)
+    raw_flows = rng.integers(0, 100000, (len(times), len(feature_ids)), dtype=np.int32)
+    raw_flows[::13, 5] = FILL_VALUE
+
+    group = zarr.open_group(path, mode='w', zarr_format=2)
+    group.create_array(
+        'time', data=np.asarray(minutes, dtype=np.int64), chunks=(500,),
+        attributes={'units': 'minutes since 1970-01-01 00:00:00 UTC'},
+    )
+    group.create_array('feature_id', data=feature_ids, chunks=(100,))
+    group.create_array(
+        'streamflow', data=raw_flows, chunks=(48, 50), fill_value=FILL_VALUE,
+        attributes={'scale_factor': 0.01},
+    )
+    zarr.consolidate_metadata(path)
+
+    flows = np.where(raw_flows == FILL_VALUE, np.nan, raw_flows * 0.01)
+    return times.to_numpy(dtype='datetime64[ns]'), feature_ids, flows
+
+
+# Filesystem that refuses every read, to prove a warm cache never reaches the target
+class OfflineFileSystem(fsspec.AbstractFileSystem):
+    cachable = False
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        raise AssertionError(f"Unexpected remote read of {path}")
+
+
+def ClearStoreCaches():
+    for cached in (
+        streamflow_plotter.OpenNWMStore, streamflow_plotter.LoadFeatureIds,
+        streamflow_plotter.GetReachIndex, streamflow_plotter.LoadTimes,
+    ):
+        cached.cache_clear()
+
+
+@pytest.fixture
+def stores(tmp_path, monkeypatch):
+    monkeypatch.setattr(streamflow_plotter, 'CACHE_DIR', str(tmp_path / 'cache'))
+    ClearStoreCaches()
+    yield {
+        str(tmp_path / name): MakeChrtoutStore(str(tmp_path / name), seed)
+        for seed, name in enumerate(('v21.zarr', 'v3.zarr'))
+    }
+    ClearStoreCaches()
+
+
+def ReadReach(url, reach_id):
+    reach_index = streamflow_plotter.GetReachIndex(url, reach_id)
+    return streamflow_plotter.GetTimeSeriesAtReach(url, reach_index, START_TIME, END_TIME)
+
+
+def AssertMatchesStore(result, expected, reach_id):
+    times, feature_ids, flows = expected
+    in_range = (times >= np.datetime64(START_TIME)) & (times <= np.datetime64(END_TIME))
+    reach_index = int(np.flatnonzero(feature_ids == reach_id)[0])
+    np.testing.assert_array_equal(result[0], times[in_range])
+    np.testing.assert_allclose(result[1], flows[in_range, reach_index])
+
+
+@pytest.mark.parametrize('attempt', range(5))
+def test_concurrent_reads_on_cold_cache(stores, tmp_path, monkeypatch, attempt):
+    cache_fs = streamflow_plotter.DiskCachedFileSystem(
+        fsspec.filesystem('file'), str(tmp_path / 'cache' / 'zarr')
+    )
+    monkeypatch.setattr(streamflow_plotter, 'GetNWMFileSystem', lambda: cache_fs)
+
+    with ThreadPoolExecutor(max_workers=len(stores)) as executor:
+        futures = {url: executor.submit(ReadReach, url, 5005) for url in stores}
+        for url, future in futures.items():
+            AssertMatchesStore(future.result(), stores[url], 5005)
+
+    assert not list((tmp_path / 'cache').rglob('*.tmp'))
+
+
+def test_warm_cache_skips_target(stores, tmp_path, monkeypatch):
+    cache_storage = str(tmp_path / 'cache' / 'zarr')
+    cache_fs = streamflow_plotter.DiskCachedFileSystem(fsspec.filesystem('file'), cache_storage)
+    monkeypatch.setattr(streamflow_plotter, 'GetNWMFileSystem', lambda: cache_fs)
+    for url in stores:
+        ReadReach(url, 5005)
+
+    # A fresh process would start with empty in-memory caches and only the disk cache
+    ClearStoreCaches()
+    offline_fs = streamflow_plotter.DiskCachedFileSystem(OfflineFileSystem(), cache_storage)
+    monkeypatch.setattr(streamflow_plotter, 'GetNWMFileSystem', lambda: offline_fs)
+    for url in stores:
+        AssertMatchesStore(ReadReach(url, 5005), stores[url], 5005)
+
+
+def test_nwm_readers_run_concurrently_on_cold_cache(stores, tmp_path, monkeypatch):
+    cache_fs = streamflow_plotter.DiskCachedFileSystem(
+        fsspec.filesystem('file'), str(tmp_path / 'cache' / 'zarr')
+    )
+    monkeypatch.setattr(streamflow_plotter, 'GetNWMFileSystem', lambda: cache_fs)
+    url_v21, url_v3 = stores
+    monkeypatch.setattr(streamflow_plotter, 'NWM_V21_URL', url_v21)
+    monkeypatch.setattr(streamflow_plotter, 'NWM_V3_URL', url_v3)
+
+    # Same pattern as the script's main block
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_v21 = executor.submit(streamflow_plotter.ReadNWMv21Data, 5005, START_TIME, END_TIME)
+        future_v3 = executor.submit(streamflow_plotter.ReadNWMv3Data, 5005, START_TIME, END_TIME)
+
+        AssertMatchesStore(future_v21.result(), stores[url_v21], 5005)
+        AssertMatchesStore(future_v3.result(), stores[url_v3], 5005)